@@ -1,7 +1,22 @@
 # backend.py
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import numpy as np
+import os
 import pandas as pd
 from pathlib import Path
 import re
+import sys
+import tempfile
+import threading
+
+try:
+    import streamlit as st
+except ImportError:  # backend can be used from the CLI without Streamlit
+    st = None
+
+log = logging.getLogger(__name__)
 
 # === Folder and file setup ===
 DATA_DIR = Path("data")
@@ -10,125 +25,443 @@ DATA_DIR.mkdir(exist_ok=True)
 RAINFALL_CSV = DATA_DIR / "rainfall_data.csv"
 CROP_CSV = DATA_DIR / "crop_production.csv"
 
+# Cleaned copies of the CSVs, rebuilt whenever the source CSV is newer. Bump
+# the version whenever the cleaning changes what is written, so copies left
+# by an older checkout are ignored instead of served with the wrong layout.
+PARQUET_VERSION = 2
+RAINFALL_PARQUET = DATA_DIR / f"rainfall_data.v{PARQUET_VERSION}.parquet"
+CROP_PARQUET = DATA_DIR / f"crop_long.v{PARQUET_VERSION}.parquet"
+
+# Column dtypes of the cleaned frames; a Parquet copy that doesn't match is rebuilt
+RAINFALL_DTYPES = {"STATE": "category", "YEAR": "int16", "AVG_RAINFALL": "float32"}
+CROP_DTYPES = {"State": "category", "Production": "double[pyarrow]", "Year": "category", "Crop": "category"}
+
+# Crop header parsing: season (e.g. 2009-10), units/category noise, and the
+# trailing "2009 10" year left once dashes become spaces
+_CROP_YEAR = re.compile(r"(\d{4}-\d{2})")
+_CROP_NOISE = re.compile(r"\(.*?\)|Food Grains|Oilseeds|Cereals|Production")
+_CROP_YEAR_TAIL = re.compile(r"\s+\d{4}\s*\d{2}")
+
+
+def _session_cache(func):
+    """Cache a loader once per process, under Streamlit or from the CLI.
+
+    Cached frames are shared rather than copied on each hit (cache_resource,
+    not cache_data), so callers must treat them as read-only. Only the latest
+    CSV version is kept, so editing a file replaces the cached frame rather
+    than accumulating one entry per mtime.
+
+    Each loader gets its own lock, so two threads that miss the cache at once
+    (e.g. a query during the background preload) don't both parse the CSV and
+    write the same Parquet copy; the second waits and then hits the cache.
+    Loaders for different datasets don't block each other, and a loader only
+    ever calls loaders it is built from, so the locks are taken in one order.
+    """
+    if st is not None and st.runtime.exists():
+        cached = st.cache_resource(show_spinner=False, max_entries=1)(func)
+    else:
+        cached = functools.lru_cache(maxsize=1)(func)
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def load(*args):
+        with lock:
+            return cached(*args)
+
+    return load
+
+
+def _source_mtime(csv_path, parquet_path):
+    """mtime of the CSV, or of the Parquet copy when shipped without the CSV."""
+    for path in (csv_path, parquet_path):
+        if path.exists():
+            return path.stat().st_mtime
+    return None
+
+
+def _state_key(name):
+    """Normalized form of a state name, as stored in the cleaned frames."""
+    return str(name).strip().lower()
+
+
+def _normalize_states(states):
+    """Normalize a state column once at load time into a categorical.
+
+    The string ops run over the distinct names rather than every row.
+    """
+    states = states.astype("category")
+    keys = states.cat.categories.astype(str).str.strip().str.lower()
+    if keys.is_unique:
+        return states.cat.rename_categories(keys)
+    # Names differing only in case/whitespace collapse into one category
+    return states.map(dict(zip(states.cat.categories, keys))).astype("category")
+
+
+def _parquet_is_fresh(csv_path, parquet_path):
+    return parquet_path.exists() and (
+        not csv_path.exists() or parquet_path.stat().st_mtime >= csv_path.stat().st_mtime
+    )
+
+
+def _read_parquet(parquet_path, dtypes):
+    """Read a cleaned Parquet copy, or return None if it is unreadable or stale."""
+    try:
+        df = pd.read_parquet(parquet_path, engine="pyarrow")
+    except (OSError, ValueError) as e:
+        log.warning("⚠️ Could not read %s: %s", parquet_path, e)
+        return None
+    found = df.dtypes.astype(str).to_dict()
+    if found != dtypes:
+        log.warning("⚠️ Unexpected columns in %s: %s (expected %s)", parquet_path, found, dtypes)
+        return None
+    return df
+
+
+def _write_parquet(df, parquet_path):
+    """Write to a temporary file and swap it in, so readers never see a partial copy."""
+    fd, tmp_path = tempfile.mkstemp(dir=parquet_path.parent, prefix=parquet_path.name, suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, engine="pyarrow", compression="zstd", index=False)
+        os.replace(tmp_path, parquet_path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def _materialize_parquet(csv_path, parquet_path, clean, dtypes):
+    """Return the cleaned frame, running `clean` only if the Parquet copy is stale.
+
+    A copy that can't be read or has the wrong dtypes counts as stale.
+    """
+    if _parquet_is_fresh(csv_path, parquet_path):
+        df = _read_parquet(parquet_path, dtypes)
+        if df is not None:
+            log.info("✅ Loaded %d cleaned rows from %s", len(df), parquet_path)
+            return df
+
+    if not csv_path.exists():
+        log.error("❌ No usable Parquet copy and no CSV at: %s", csv_path)
+        return pd.DataFrame()
+
+    df = clean()
+    if not df.empty:
+        try:
+            _write_parquet(df, parquet_path)
+        except (OSError, ValueError) as e:
+            log.warning("⚠️ Could not write %s: %s", parquet_path, e)
+    return df
+
+
+def _read_csv(path, usecols, dtypes, na_values=None):
+    """Parse with the Arrow CSV reader, typing numeric columns during the parse.
+
+    Falls back to an untyped parse plus one to_numeric(errors="coerce") pass
+    if a numeric column holds text Arrow can't convert. Either way the
+    numeric columns come back with the requested `dtypes`.
+    """
+    kwargs = dict(engine="pyarrow", dtype_backend="pyarrow", usecols=usecols, na_values=na_values)
+    try:
+        return pd.read_csv(path, dtype=dtypes, **kwargs)
+    except ValueError as e:
+        log.warning("⚠️ Non-numeric values in %s, coercing after parse: %s", path, e)
+        df = pd.read_csv(path, **kwargs)
+        numeric_cols = list(dtypes)
+        # via object: to_numeric on Arrow strings leaves unparseable cells non-null
+        df[numeric_cols] = df[numeric_cols].astype(object).apply(pd.to_numeric, errors="coerce")
+        return df.astype(dtypes)
+
 
 def get_rainfall_data():
-    """Load and clean rainfall data with flexible column detection."""
-    if not RAINFALL_CSV.exists():
-        print(f"❌ Rainfall CSV not found at: {RAINFALL_CSV}")
+    """Load and clean rainfall data with flexible column detection.
+
+    The cleaned frame is cached and shared between calls, so callers must not
+    modify it in place.
+    """
+    mtime = _source_mtime(RAINFALL_CSV, RAINFALL_PARQUET)
+    if mtime is None:
+        log.error("❌ Rainfall CSV not found at: %s", RAINFALL_CSV)
         return pd.DataFrame()
 
-    df = pd.read_csv(RAINFALL_CSV)
-    print(f"✅ Loaded {len(df)} rainfall records")
+    # Keyed by mtime so editing the CSV invalidates the cache
+    return _load_rainfall_data(mtime)
+
+
+@_session_cache
+def _load_rainfall_data(mtime):
+    return _materialize_parquet(RAINFALL_CSV, RAINFALL_PARQUET, _clean_rainfall_csv, RAINFALL_DTYPES)
 
-    # Normalize column names
-    df.columns = df.columns.str.strip().str.upper().str.replace(" ", "_")
+
+def _clean_rainfall_csv():
+    # Normalize column names from the header alone (normalized -> raw)
+    header = pd.read_csv(RAINFALL_CSV, nrows=0).columns
+    columns = dict(zip(header.str.strip().str.upper().str.replace(" ", "_"), header))
 
     # Try to detect the right columns automatically
-    state_col = next((c for c in df.columns if "STATE" in c or "UT" in c), None)
-    year_col = next((c for c in df.columns if "YEAR" in c), None)
-    rain_col = next((c for c in df.columns if "RAIN" in c and "AVG" in c), None)
+    state_col = next((c for c in columns if "STATE" in c or "UT" in c), None)
+    year_col = next((c for c in columns if "YEAR" in c), None)
+    rain_col = next((c for c in columns if "RAIN" in c and "AVG" in c), None)
 
     if not all([state_col, year_col, rain_col]):
-        print(f"⚠️ Missing columns! Found: {df.columns.tolist()}")
+        log.warning("⚠️ Missing columns! Found: %s", list(columns))
         return pd.DataFrame()
 
-    df = df[[state_col, year_col, rain_col]].copy()
+    # Parse only the three columns we use
+    picked = [columns[state_col], columns[year_col], columns[rain_col]]
+    dtypes = {columns[year_col]: "int16[pyarrow]", columns[rain_col]: "float32[pyarrow]"}
+    df = _read_csv(RAINFALL_CSV, picked, dtypes)
+    log.info("✅ Loaded %d rainfall records", len(df))
+
+    df = df[picked].copy()
     df.columns = ["STATE", "YEAR", "AVG_RAINFALL"]
 
-    # Convert types
-    df["AVG_RAINFALL"] = pd.to_numeric(df["AVG_RAINFALL"], errors="coerce")
-    df["YEAR"] = pd.to_numeric(df["YEAR"], errors="coerce")
     df.dropna(subset=["STATE", "YEAR", "AVG_RAINFALL"], inplace=True)
+    df = df.astype({"YEAR": "int16", "AVG_RAINFALL": "float32"})
+
+    # Normalize once so queries compare category codes, not strings
+    df["STATE"] = _normalize_states(df["STATE"])
 
-    print(f"✅ Cleaned rainfall data: {df.shape[0]} rows")
+    log.info("✅ Cleaned rainfall data: %d rows", df.shape[0])
     return df
 
 
-def compare_average_rainfall(state_x, state_y, last_n_years=5):
-    """Compare average rainfall between two states."""
-    df = get_rainfall_data()
+def get_rainfall_tables():
+    """Rainfall summary, its ascending distinct years and its state index.
+
+    The three are built together once per CSV version, so a query that
+    reads all of them never mixes tables from two versions of the file.
+    """
+    mtime = _source_mtime(RAINFALL_CSV, RAINFALL_PARQUET)
+    if mtime is None:
+        return pd.DataFrame(), np.empty(0, dtype="int16"), {}
+    return _rainfall_tables(mtime)
+
+
+def get_rainfall_summary():
+    """Rainfall total and reading count per (state, year), computed once."""
+    return get_rainfall_tables()[0]
+
+
+def get_rainfall_years():
+    """Distinct years in the rainfall data, ascending, computed once."""
+    return get_rainfall_tables()[1]
+
+
+def get_rainfall_state_index():
+    """Map each normalized state to its rows in `get_rainfall_summary()`."""
+    return get_rainfall_tables()[2]
+
+
+@_session_cache
+def _rainfall_tables(mtime):
+    summary = _summarize_rainfall(_load_rainfall_data(mtime))
+    if summary.empty:
+        return summary, np.empty(0, dtype="int16"), {}
+    return summary, np.sort(summary["YEAR"].unique()), _state_ranges(summary["STATE"])
+
+
+def _summarize_rainfall(df):
     if df.empty:
-        return {"error": "Rainfall data not available or invalid."}
+        return df
+    # Totals and counts (not means) so multi-year averages stay exact
+    return (
+        df["AVG_RAINFALL"]
+        .astype("float64")
+        .groupby([df["STATE"], df["YEAR"]], observed=True)
+        .agg(TOTAL="sum", COUNT="count")
+        .astype({"COUNT": "int32"})
+        .reset_index()
+    )
 
-    # Get recent years safely
-    if "YEAR" in df.columns:
-        years_sorted = sorted(df["YEAR"].dropna().unique())
-        if len(years_sorted) == 0:
-            return {"error": "No valid year data found."}
-        recent_years = years_sorted[-last_n_years:]
-        df = df[df["YEAR"].isin(recent_years)]
 
-    # Compute averages
-    avg_x = df[df["STATE"].str.lower().str.strip() == state_x.lower()]["AVG_RAINFALL"].mean()
-    avg_y = df[df["STATE"].str.lower().str.strip() == state_y.lower()]["AVG_RAINFALL"].mean()
+def _state_ranges(states):
+    """Map each state key to its slice of rows.
 
-    if pd.isna(avg_x) or pd.isna(avg_y):
-        print(f"⚠️ Could not find rainfall data for {state_x} or {state_y}")
-        print("Available states:", df["STATE"].unique().tolist())
-        return {"error": "Could not compute rainfall averages for given states."}
+    The summaries come out of a sorted group-by, so each state's rows are
+    contiguous and lookups become zero-copy iloc slices.
+    """
+    rows = states.groupby(states, observed=True, sort=False).indices
+    return {key: slice(int(r[0]), int(r[-1]) + 1) for key, r in rows.items()}
 
-    return {
-        "State X": state_x,
-        "State Y": state_y,
-        "Average Rainfall X (mm)": round(avg_x, 2),
-        "Average Rainfall Y (mm)": round(avg_y, 2),
-        "Years Considered": last_n_years,
-    }
 
+def _recent_year_threshold(sorted_years, n):
+    """Earliest of the `n` (>= 1) most recent years in ascending, distinct `sorted_years`.
+
+    Rows with `year >= threshold` are exactly the last `n` years, so callers
+    filter with one comparison instead of an isin hash lookup.
+    """
+    return sorted_years[-min(n, len(sorted_years))]
+
+
+def _sum_by_category(keys, values):
+    """Group-by-sum of `values` over categorical `keys` in one NumPy pass.
+
+    Equivalent to ``values.groupby(keys, observed=True).sum()``.
+    """
+    categories = keys.cat.categories
+    codes = keys.cat.codes.to_numpy()
+    totals = np.bincount(codes, weights=values.to_numpy(), minlength=len(categories))
+    observed = np.bincount(codes, minlength=len(categories)) > 0
+    index = pd.Index(categories[observed], name=keys.name)
+    return pd.Series(totals[observed], index=index, name=values.name)
+
+
+def _rows_for_state(df, state_index, state):
+    """Select the rows of `df` for `state` without scanning the whole frame."""
+    rows = state_index.get(_state_key(state))
+    return df.iloc[:0] if rows is None else df.iloc[rows]
 
 
 # --- Load Crop Data ---
 def get_crop_data():
-    """Load and clean crop production data."""
-    if not CROP_CSV.exists():
-        print(f"❌ Crop CSV not found at: {CROP_CSV}")
+    """Load and clean crop production data (cached, treat as read-only)."""
+    mtime = _source_mtime(CROP_CSV, CROP_PARQUET)
+    if mtime is None:
+        log.error("❌ Crop CSV not found at: %s", CROP_CSV)
         return pd.DataFrame()
 
-    df = pd.read_csv(CROP_CSV)
-    print(f"✅ Loaded {len(df)} crop records")
+    return _load_crop_data(mtime)
+
+
+@_session_cache
+def _load_crop_data(mtime):
+    return _materialize_parquet(CROP_CSV, CROP_PARQUET, _clean_crop_csv, CROP_DTYPES)
+
+
+def _clean_crop_csv():
+    # Only the state column and the per-year crop columns are melted
+    header = pd.read_csv(CROP_CSV, nrows=0).columns
+    picked = [c for c in header if "State" in c.strip().title() or _CROP_YEAR.search(c)]
+    dtypes = {c: "float64[pyarrow]" for c in picked if _CROP_YEAR.search(c)}
+    # The source marks missing figures with "-" and "#" besides "NA"
+    df = _read_csv(CROP_CSV, picked, dtypes, na_values=["-", "#"])
+    log.info("✅ Loaded %d crop records", len(df))
 
     # Standardize and rename
-    df.columns = df.columns.str.strip().str.title()
-    for col in df.columns:
-        if "State" in col:
-            df.rename(columns={col: "State"}, inplace=True)
+    cols = df.columns.str.strip().str.title()
+    df.columns = cols.where(~cols.str.contains("State", regex=False), "State")
 
     # Convert to long format
     df_long = df.melt(id_vars=["State"], var_name="Crop_Year", value_name="Production")
 
+    # Arrow-backed strings so the regex passes below run as Arrow kernels
+    # (those only take pattern strings, not compiled re objects)
+    df_long["Crop_Year"] = df_long["Crop_Year"].astype("string[pyarrow]")
+
     # Extract year (e.g., 2009-10)
-    df_long["Year"] = df_long["Crop_Year"].str.extract(r"(\d{4}-\d{2})")
+    df_long["Year"] = df_long["Crop_Year"].str.extract(_CROP_YEAR.pattern)
 
     # Extract and clean crop name
     df_long["Crop"] = (
         df_long["Crop_Year"]
-        .str.replace(r"\(.*?\)", "", regex=True)
-        .str.replace(r"Food Grains|Oilseeds|Cereals|Production", "", regex=True)
-        .str.replace("-", " ")
+        .str.replace(_CROP_NOISE.pattern, "", regex=True)
+        .str.replace("-", " ", regex=False)
+        .str.replace(_CROP_YEAR_TAIL.pattern, "", regex=True)
         .str.strip()
     )
-    df_long["Crop"] = df_long["Crop"].apply(lambda x: re.sub(r"\s+\d{4}\s*\d{2}", "", x).strip())
 
-    df_long["Production"] = pd.to_numeric(df_long["Production"], errors="coerce")
     df_long.dropna(subset=["State", "Crop", "Production"], inplace=True)
 
+    # Low-cardinality keys: normalize state once, store all as categories
+    df_long["State"] = _normalize_states(df_long["State"])
+    df_long = df_long.astype({"Crop": "category", "Year": "category", "Production": "float64[pyarrow]"})
+
+    # The raw header text is only needed for parsing; don't persist it
+    df_long = df_long.drop(columns="Crop_Year")
+
     return df_long
 
 
+def get_crop_tables():
+    """Crop summary and its state index, built together once per CSV version."""
+    mtime = _source_mtime(CROP_CSV, CROP_PARQUET)
+    return (pd.DataFrame(), {}) if mtime is None else _crop_tables(mtime)
+
+
+def get_crop_summary():
+    """Production per (state, season, crop), computed once."""
+    return get_crop_tables()[0]
+
+
+def get_crop_state_index():
+    """Map each normalized state to its rows in `get_crop_summary()`."""
+    return get_crop_tables()[1]
+
+
+@_session_cache
+def _crop_tables(mtime):
+    summary = _summarize_crops(_load_crop_data(mtime))
+    return summary, ({} if summary.empty else _state_ranges(summary["State"]))
+
+
+def _summarize_crops(df):
+    if df.empty:
+        return df
+    summary = (
+        df.groupby(["State", "Year", "Crop"], observed=True, dropna=False)["Production"]
+        .sum()
+        .reset_index()
+    )
+    # "2009-10" style seasons sort chronologically, so allow >= comparisons
+    summary["Year"] = summary["Year"].cat.as_ordered()
+    return summary
+
+
+# --- Background Preload ---
+def _preload_datasets():
+    get_rainfall_tables()
+    get_crop_tables()
+
+
+def _log_preload_failure(future):
+    if future.exception() is not None:
+        log.warning("⚠️ Background preload failed, loading on demand: %s", future.exception())
+
+
+# Parse the datasets while the UI renders instead of on the first click.
+# Callers need not wait for it: each cached loader serializes its own misses.
+_preload = ThreadPoolExecutor(max_workers=1).submit(_preload_datasets)
+_preload.add_done_callback(_log_preload_failure)
+
+
+def prebuild_parquet():
+    """Write the cleaned Parquet copies ahead of time (e.g. as a deploy step).
+
+    Goes through the cached loaders, which write any stale copy and share
+    their locks with the warm-up writing the same files.
+    """
+    get_rainfall_data()
+    get_crop_data()
+
+
 # --- Compare Rainfall ---
+def _average_rainfall(summary, state_index, state, first_year):
+    """Mean rainfall for `state` over years >= `first_year` (NaN if no data).
+
+    Reduces the state's slice of the summary straight to two scalars, with
+    no intermediate frame or group-by.
+    """
+    rows = _rows_for_state(summary, state_index, state)
+    recent = rows["YEAR"].to_numpy() >= first_year
+    count = rows["COUNT"].to_numpy()[recent].sum()
+    return rows["TOTAL"].to_numpy()[recent].sum() / count if count else np.nan
+
+
 def compare_average_rainfall(state_x, state_y, last_n_years=5):
-    df = get_rainfall_data()
-    if isinstance(df, dict):
-        return df
+    """Compare average rainfall between two states."""
+    if last_n_years < 1:
+        return {"error": "Number of years must be at least 1."}
+
+    # One lookup, so all three tables come from the same CSV version
+    df, years, state_index = get_rainfall_tables()
     if df.empty:
         return {"error": "Rainfall data not available or invalid."}
 
     # Filter last N years
-    recent_years = sorted(df["YEAR"].dropna().unique())[-last_n_years:]
-    df = df[df["YEAR"].isin(recent_years)]
+    first_year = _recent_year_threshold(years, last_n_years)
 
-    avg_x = df[df["STATE"].str.lower() == state_x.lower()]["AVG_RAINFALL"].mean()
-    avg_y = df[df["STATE"].str.lower() == state_y.lower()]["AVG_RAINFALL"].mean()
+    avg_x = _average_rainfall(df, state_index, state_x, first_year)
+    avg_y = _average_rainfall(df, state_index, state_y, first_year)
 
     if pd.isna(avg_x) or pd.isna(avg_y):
         return {"error": "Could not compute rainfall averages for given states."}
@@ -136,32 +469,34 @@ def compare_average_rainfall(state_x, state_y, last_n_years=5):
     return {
         "State X": state_x,
         "State Y": state_y,
-        "Average Rainfall X (mm)": round(avg_x, 2),
-        "Average Rainfall Y (mm)": round(avg_y, 2),
+        "Average Rainfall X (mm)": round(float(avg_x), 2),
+        "Average Rainfall Y (mm)": round(float(avg_y), 2),
         "Years Considered": last_n_years,
     }
 
 
 # --- Top Crops ---
 def top_crops_in_state(state, top_m=3, last_n_years=5):
-    df = get_crop_data()
+    if last_n_years < 1:
+        return {"error": "Number of years must be at least 1."}
+
+    df, state_index = get_crop_tables()
     if df.empty:
         return {"error": "Crop production data not available or invalid."}
 
-    df_state = df[df["State"].str.lower() == state.lower()]
+    df_state = _rows_for_state(df, state_index, state)
     if df_state.empty:
         return {"error": f"No crop data found for state: {state}"}
 
     # Filter last N years (if numeric-like)
     if df_state["Year"].notna().any():
-        recent_years = sorted(df_state["Year"].dropna().unique())[-last_n_years:]
-        df_state = df_state[df_state["Year"].isin(recent_years)]
+        # The summary is sorted by (state, season), so this is already ascending
+        first_year = _recent_year_threshold(df_state["Year"].dropna().unique(), last_n_years)
+        df_state = df_state.loc[df_state["Year"] >= first_year, ["Crop", "Production"]]
 
     summary = (
-        df_state.groupby("Crop")["Production"]
-        .sum()
-        .sort_values(ascending=False)
-        .head(top_m)
+        _sum_by_category(df_state["Crop"], df_state["Production"])
+        .nlargest(top_m)
         .reset_index()
     )
 
@@ -173,6 +508,11 @@ def top_crops_in_state(state, top_m=3, last_n_years=5):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if "--prebuild" in sys.argv:
+        prebuild_parquet()
+        sys.exit()
+
     print("Testing backend locally...")
     print(compare_average_rainfall("Maharashtra", "Kerala"))
     print(top_crops_in_state("Punjab"))